@@ -1,18 +1,25 @@
+import asyncio
+import io
 import logging
 import os
-import tempfile
-from collections import defaultdict
-from datetime import datetime, timedelta
-from hashlib import sha256
-from urllib.parse import urlparse
+import re
 import time
+import zipfile
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from datetime import datetime
+from functools import lru_cache
+from hashlib import blake2b
+from string import Template
+from urllib.parse import ParseResult, urlparse
 
-from fastapi import FastAPI, HTTPException, Request
+from fastapi import FastAPI, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import Response
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
 from starlette.responses import RedirectResponse
-from typing import Optional
+from typing import Annotated, Literal, Optional
 from playwright.async_api import async_playwright
+from pydantic import BaseModel, Field
 
 # Configure logging
 logging.basicConfig(
@@ -24,7 +31,8 @@ logger = logging.getLogger(__name__)
 app = FastAPI(
     title="Web to PDF Converter",
     description="Web page to PDF conversion using Playwright on Google Cloud Run",
-    version="3.0.0"
+    version="3.0.0",
+    default_response_class=ORJSONResponse
 )
 
 app.add_middleware(
@@ -35,34 +43,412 @@ app.add_middleware(
     allow_credentials=False,
 )
 
-# Simple in-memory rate limiting
-rate_limit_storage = defaultdict(list)
+# Simple in-memory rate limiting (request count per IP and minute bucket)
+rate_limit_storage: OrderedDict[tuple[str, int], int] = OrderedDict()
 MAX_REQUESTS_PER_MINUTE = 60
+MAX_TRACKED_IPS = 100000
+RATE_LIMIT_SWEEP_SECONDS = 300
 
-def is_valid_url(url: str) -> bool:
-    """Validate URL format and scheme"""
+# User agent sent by the rendering browser, tagged with the viewport size
+USER_AGENT_BASE = 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36 PDF-Generator'
+USER_AGENT_TEMPLATE = USER_AGENT_BASE + ' Viewport-{}x{}'
+
+# Ad and tracking networks whose requests are aborted while rendering
+AD_HOSTS = frozenset({
+    'doubleclick.net',
+    'googlesyndication.com',
+    'googletagmanager.com',
+    'googletagservices.com',
+    'google-analytics.com',
+    'googleadservices.com',
+    'adservice.google.com',
+    'facebook.net',
+    'amazon-adsystem.com',
+    'adnxs.com',
+    'scorecardresearch.com',
+    'hotjar.com',
+    'taboola.com',
+    'outbrain.com',
+    'criteo.com',
+})
+AD_HOST_PATTERN = re.compile(r'(^|\.)(' + '|'.join(re.escape(domain) for domain in sorted(AD_HOSTS)) + r')$')
+
+# Scrolls through the page to trigger lazy loading, waits for the elements
+# matching the given selector to load, then scrolls back to the top.
+# Returns the number of matching elements; does nothing when there are none.
+WAIT_FOR_MEDIA_JS = '''
+    async (selector) => {
+        if (!document.querySelector(selector)) {
+            return 0;
+        }
+        
+        await new Promise(resolve => {
+            let totalHeight = 0;
+            const distance = 100;
+            const timer = setInterval(() => {
+                const scrollHeight = document.body.scrollHeight;
+                window.scrollBy(0, distance);
+                totalHeight += distance;
+                
+                if(totalHeight >= scrollHeight){
+                    clearInterval(timer);
+                    resolve();
+                }
+            }, 100);
+        });
+        
+        const elements = Array.from(document.querySelectorAll(selector));
+        await Promise.all(elements.map(el => {
+            if (el.complete && el.naturalHeight !== 0) {
+                return Promise.resolve();
+            }
+            return new Promise(resolve => {
+                el.onload = () => resolve();
+                el.onerror = () => resolve(); // Resolve even on error to not block
+                // Set a timeout to avoid hanging
+                setTimeout(() => resolve(), 5000);
+            });
+        }));
+        
+        window.scrollTo(0, 0);
+        return elements.length;
+    }
+'''
+
+# A comma-separated value without surrounding whitespace (inner spaces are kept for selectors like 'div p')
+CSV_VALUE_PATTERN = re.compile(r'[^,\s](?:[^,]*[^,\s])?')
+
+# Rules applied to each selector given in the hide and page break parameters
+HIDE_RULE_TEMPLATE = '{} {{ display: none !important; }}'
+BREAK_BEFORE_RULE_TEMPLATE = '{} {{ break-before: page !important; page-break-before: always !important; }}'
+BREAK_AFTER_RULE_TEMPLATE = '{} {{ break-after: page !important; page-break-after: always !important; }}'
+KEEP_TOGETHER_RULE_TEMPLATE = '{} {{ break-inside: avoid !important; page-break-inside: avoid !important; }}'
+
+# Static print rules appended after the per-request rules in @media print
+PRINT_CSS_DEFAULTS = """
+    /* Good defaults for print */
+    * {
+        -webkit-print-color-adjust: exact !important;
+        color-adjust: exact !important;
+    }
+    
+    /* Better typography for print */
+    body {
+        font-size: 12pt;
+        line-height: 1.4;
+    }
+    
+    h1, h2, h3, h4, h5, h6 {
+        break-after: avoid !important;
+        page-break-after: avoid !important;
+    }
+    
+    p, li {
+        orphans: 3;
+        widows: 3;
+    }
+    
+    img {
+        max-width: 100% !important;
+        break-inside: avoid !important;
+        page-break-inside: avoid !important;
+    }
+    
+    table {
+        break-inside: avoid !important;
+        page-break-inside: avoid !important;
+    }
+    
+    pre, blockquote {
+        break-inside: avoid !important;
+        page-break-inside: avoid !important;
+    }
+"""
+PRINT_CSS_TEMPLATE = Template('@media print {\n$rules\n' + PRINT_CSS_DEFAULTS + '\n}\n')
+
+# Payloads above STREAM_THRESHOLD are streamed to the client in PDF_CHUNK_SIZE chunks
+PDF_CHUNK_SIZE = 64 * 1024
+STREAM_THRESHOLD = 10 * 1024 * 1024
+
+# Maximum number of PDFs rendered concurrently
+PDF_CONCURRENCY = int(os.getenv("PDF_CONCURRENCY", "4"))
+pdf_semaphore = asyncio.Semaphore(PDF_CONCURRENCY)
+
+# Requests waiting for a render slot; beyond PDF_MAX_QUEUE new requests get a 503
+pdf_queue_depth = 0
+PDF_MAX_QUEUE = int(os.getenv("PDF_MAX_QUEUE", "16"))
+PDF_RETRY_AFTER = "5"
+
+# Maximum number of URLs accepted by a single /pdf/batch request
+PDF_BATCH_MAX_URLS = 20
+
+# In-memory LRU cache of generated PDFs and their ETags, bounded by total size in bytes and entry age
+pdf_cache: OrderedDict[str, tuple[float, bytes, str]] = OrderedDict()
+pdf_cache_bytes = 0
+PDF_CACHE_TTL = int(os.getenv("PDF_CACHE_TTL", "300"))
+PDF_CACHE_MAX_BYTES = int(os.getenv("PDF_CACHE_MAX_BYTES", str(200 * 1024 * 1024)))
+
+class PdfParams(BaseModel):
+    """Query parameters accepted by the /pdf endpoint"""
+    url: str
+    displayHeaderFooter: bool = True
+    landscape: bool = False
+    marginBottom: str = "0.5in"
+    marginLeft: str = "0.2in"
+    marginRight: str = "0.2in"
+    marginTop: str = "0.75in"
+    pageRanges: str = ''
+    format: str = "Letter"  # A4, Letter, Legal, etc.
+    width: Optional[str] = None  # PDF page width (e.g., "8.5in", "210mm")
+    height: Optional[str] = None  # PDF page height (e.g., "11in", "297mm")
+    printBackground: bool = True
+    scale: Annotated[float, Field(ge=0.1, le=2.0)] = 0.9
+    timeout: Annotated[int, Field(ge=5000, le=180000)] = 180000  # Playwright uses milliseconds
+    waitForImages: bool = True  # Wait for images to load
+    waitForIframes: bool = True  # Wait for iframes to load
+    waitTime: Annotated[int, Field(ge=0, le=30000)] = 2000  # Additional wait time in milliseconds
+    waitUntil: Literal['load', 'domcontentloaded', 'networkidle', 'commit'] = 'domcontentloaded'  # Navigation event to wait for
+    enableJavaScript: bool = True  # Enable/disable JavaScript
+    viewportWidth: Annotated[int, Field(ge=320, le=4000)] = 1280  # Page width for rendering
+    viewportHeight: Annotated[int, Field(ge=240, le=4000)] = 720  # Page height for rendering
+    deviceScaleFactor: float = 1.0  # Device pixel ratio
+    preferCSSPageSize: bool = False  # Use CSS @page size
+    hideElements: Optional[str] = None  # CSS selectors to hide (comma-separated)
+    hideClasses: Optional[str] = None  # Class names to hide (comma-separated)
+    hideIds: Optional[str] = None  # IDs to hide (comma-separated)
+    hideTags: Optional[str] = None  # HTML tags to hide (comma-separated)
+    pageBreakBefore: Optional[str] = None  # CSS selectors to force page break before
+    pageBreakAfter: Optional[str] = None  # CSS selectors to force page break after
+    keepTogether: Optional[str] = None  # CSS selectors to avoid breaking inside
+    customCSS: Optional[str] = None  # Custom CSS to inject
+    blockResources: str = "media,websocket,eventsource,manifest"  # Resource types to block (comma-separated)
+
+class PdfBatchRequest(BaseModel):
+    """Body accepted by the /pdf/batch endpoint"""
+    urls: Annotated[list[PdfParams], Field(min_length=1, max_length=PDF_BATCH_MAX_URLS)]  # URL and options per document
+    concurrency: Annotated[int, Field(ge=1, le=16)] = 4  # Documents rendered at once for this batch
+
+def parse_url(url: str) -> Optional[ParseResult]:
+    """Parse a URL, returning None unless it is a valid http(s) URL"""
     try:
         parsed = urlparse(url)
-        return parsed.scheme in ('http', 'https') and bool(parsed.netloc)
     except Exception:
-        return False
+        return None
+    return parsed if parsed.scheme in ('http', 'https') and parsed.netloc else None
 
-def is_rate_limited(client_ip: str) -> bool:
-    """Simple rate limiting check"""
-    now = datetime.now()
-    minute_ago = now - timedelta(minutes=1)
+def is_rate_limited(client_ip: str, cost: int = 1) -> bool:
+    """Simple rate limiting check, counting cost requests against the client"""
+    key = (client_ip, int(time.monotonic()) // 60)
+    count = rate_limit_storage.get(key, 0) + cost
+    if count > MAX_REQUESTS_PER_MINUTE:
+        return True
     
-    rate_limit_storage[client_ip] = [
-        timestamp for timestamp in rate_limit_storage[client_ip] 
-        if timestamp > minute_ago
-    ]
+    rate_limit_storage[key] = count
     
-    if len(rate_limit_storage[client_ip]) >= MAX_REQUESTS_PER_MINUTE:
-        return True
+    # Keep the most recently seen IPs and evict the least recently seen
+    rate_limit_storage.move_to_end(key)
+    if len(rate_limit_storage) > MAX_TRACKED_IPS:
+        rate_limit_storage.popitem(last=False)
     
-    rate_limit_storage[client_ip].append(now)
     return False
 
+async def sweep_rate_limits():
+    """Periodically drop rate limit buckets from minutes that have passed"""
+    while True:
+        await asyncio.sleep(RATE_LIMIT_SWEEP_SECONDS)
+        current_bucket = int(time.monotonic()) // 60
+        expired = [key for key in rate_limit_storage if key[1] < current_bucket - 1]
+        for key in expired:
+            del rate_limit_storage[key]
+        if expired:
+            logger.info(f'Swept {len(expired)} expired rate limit buckets')
+
+@lru_cache(maxsize=512)
+def split_csv(csv: str) -> tuple[str, ...]:
+    """Split a comma-separated parameter into its non-empty, stripped values"""
+    return tuple(CSV_VALUE_PATTERN.findall(csv))
+
+def css_rules_for(csv: Optional[str], template: str, prefix: str = '') -> list[str]:
+    """Format one CSS rule per comma-separated value, normalizing an optional selector prefix"""
+    return [template.format(prefix + value.lstrip(prefix)) for value in split_csv(csv or '')]
+
+def build_css(params: PdfParams) -> tuple[str, int]:
+    """Assemble the print stylesheet for a request, returning it with its rule count"""
+    # Width control
+    css_rules = [
+        f'''body {{
+            width: {params.viewportWidth}px !important;
+            max-width: {params.viewportWidth}px !important;
+            min-width: {params.viewportWidth}px !important;
+        }}''',
+        f'''.container, .main, #main, #content, .content {{
+            width: {params.viewportWidth}px !important;
+            max-width: {params.viewportWidth}px !important;
+        }}'''
+    ]
+    
+    # Hide elements
+    css_rules += css_rules_for(params.hideElements, HIDE_RULE_TEMPLATE)
+    css_rules += css_rules_for(params.hideClasses, HIDE_RULE_TEMPLATE, prefix='.')
+    css_rules += css_rules_for(params.hideIds, HIDE_RULE_TEMPLATE, prefix='#')
+    css_rules += css_rules_for(params.hideTags, HIDE_RULE_TEMPLATE)
+    
+    # Page break controls
+    css_rules += css_rules_for(params.pageBreakBefore, BREAK_BEFORE_RULE_TEMPLATE)
+    css_rules += css_rules_for(params.pageBreakAfter, BREAK_AFTER_RULE_TEMPLATE)
+    css_rules += css_rules_for(params.keepTogether, KEEP_TOGETHER_RULE_TEMPLATE)
+    
+    # Custom CSS
+    if params.customCSS:
+        css_rules.append(params.customCSS)
+    
+    # Build complete CSS with print media queries
+    return PRINT_CSS_TEMPLATE.substitute(rules='\n'.join(css_rules)), len(css_rules)
+
+def is_ad_host(url: str) -> bool:
+    """Check whether a request URL belongs to a known ad or tracking network"""
+    return AD_HOST_PATTERN.search(urlparse(url).hostname or '') is not None
+
+def resource_blocker(blocked_types: frozenset):
+    """Build a route handler that aborts blocked resource types and ad/tracker requests"""
+    async def handle_route(route):
+        if route.request.resource_type in blocked_types or is_ad_host(route.request.url):
+            await route.abort()
+        else:
+            await route.continue_()
+    return handle_route
+
+@asynccontextmanager
+async def pdf_slot():
+    """Hold one of the PDF_CONCURRENCY render slots, counting requests that wait for it"""
+    global pdf_queue_depth
+    pdf_queue_depth += 1
+    try:
+        await pdf_semaphore.acquire()
+    finally:
+        pdf_queue_depth -= 1
+    try:
+        yield
+    finally:
+        pdf_semaphore.release()
+
+async def iter_chunks(content: bytes, chunk_size: int = PDF_CHUNK_SIZE):
+    """Yield a byte buffer in fixed-size chunks for streaming responses"""
+    view = memoryview(content)
+    for start in range(0, len(view), chunk_size):
+        yield view[start:start + chunk_size]
+
+def pdf_etag(pdf_content: bytes) -> str:
+    """Compute a strong ETag from the PDF bytes"""
+    return f'"{blake2b(pdf_content, digest_size=16).hexdigest()}"'
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """Check whether the client already holds this version of the PDF"""
+    if_none_match = request.headers.get('if-none-match')
+    if not if_none_match:
+        return False
+    return if_none_match.strip() == '*' or etag in (tag.strip() for tag in if_none_match.split(','))
+
+def download_response(content: bytes, media_type: str, headers: dict) -> Response:
+    """Send small payloads in one piece and stream large ones in chunks, always with a known length"""
+    headers["Content-Length"] = str(len(content))
+    if len(content) <= STREAM_THRESHOLD:
+        return Response(content=content, status_code=200, media_type=media_type, headers=headers)
+    return StreamingResponse(iter_chunks(content), status_code=200, media_type=media_type, headers=headers)
+
+def pdf_response(request: Request, pdf_content: bytes, etag: str, filename: str) -> Response:
+    """Build the download response for a generated PDF, or 304 if the client's copy is current"""
+    headers = {
+        "ETag": etag,
+        "Cache-Control": f"public, max-age={PDF_CACHE_TTL}",
+    }
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    
+    headers["Content-Disposition"] = f"attachment; filename={filename}"
+    return download_response(pdf_content, 'application/pdf', headers)
+
+def pdf_cache_key(params: PdfParams) -> str:
+    """Hash the URL and rendering options into a cache key"""
+    return blake2b(params.model_dump_json().encode('utf-8'), digest_size=16).hexdigest()
+
+def get_cached_pdf(key: str) -> Optional[tuple[bytes, str]]:
+    """Return a cached (PDF, ETag) pair and mark it as recently used, dropping it if expired"""
+    global pdf_cache_bytes
+    entry = pdf_cache.get(key)
+    if entry is None:
+        return None
+    
+    cached_at, pdf_content, etag = entry
+    if time.monotonic() - cached_at > PDF_CACHE_TTL:
+        del pdf_cache[key]
+        pdf_cache_bytes -= len(pdf_content)
+        return None
+    
+    pdf_cache.move_to_end(key)
+    return pdf_content, etag
+
+def cache_pdf(key: str, pdf_content: bytes, etag: str):
+    """Store a PDF, evicting least recently used entries beyond the size limit"""
+    global pdf_cache_bytes
+    if len(pdf_content) > PDF_CACHE_MAX_BYTES:
+        return
+    
+    previous = pdf_cache.pop(key, None)
+    if previous is not None:
+        pdf_cache_bytes -= len(previous[1])
+    
+    pdf_cache[key] = (time.monotonic(), pdf_content, etag)
+    pdf_cache_bytes += len(pdf_content)
+    
+    while pdf_cache_bytes > PDF_CACHE_MAX_BYTES:
+        _, (_, evicted, _) = pdf_cache.popitem(last=False)
+        pdf_cache_bytes -= len(evicted)
+
+@app.on_event("startup")
+async def startup():
+    """Start Playwright and a shared Chromium instance for all requests"""
+    app.state.pw = await async_playwright().start()
+    app.state.browser_path = str(app.state.pw.chromium.executable_path)
+    app.state.browser = await app.state.pw.chromium.launch(
+        headless=True,
+        # Web security stays enabled: cross-origin iframes still render in the PDF,
+        # and the page scripts we inject only touch the top-level document
+        args=[
+            '--no-sandbox',
+            '--no-zygote',
+            '--disable-dev-shm-usage',
+            '--disable-gpu',
+            '--disable-background-networking',
+            '--disable-background-timer-throttling',
+            '--disable-backgrounding-occluded-windows',
+            '--disable-renderer-backgrounding',
+            '--disable-sync',
+            '--metrics-recording-only',
+            '--font-render-hinting=none',
+            '--hide-scrollbars',
+            '--mute-audio'
+        ]
+    )
+    
+    # Warm up the renderer so the first request does not pay for it
+    warmup_context = await app.state.browser.new_context()
+    try:
+        warmup_page = await warmup_context.new_page()
+        await warmup_page.goto('about:blank')
+    finally:
+        await warmup_context.close()
+    logger.info('Shared Chromium browser launched')
+    app.state.rate_limit_sweeper = asyncio.create_task(sweep_rate_limits())
+
+@app.on_event("shutdown")
+async def shutdown():
+    """Close the shared browser and stop Playwright"""
+    app.state.rate_limit_sweeper.cancel()
+    await app.state.browser.close()
+    await app.state.pw.stop()
+    logger.info('Shared Chromium browser closed')
+
 @app.get('/')
 async def root():
     return RedirectResponse(url='/docs')
@@ -71,17 +457,18 @@ async def root():
 async def health_check():
     """Health check endpoint"""
     try:
-        # Test Playwright availability
-        async with async_playwright() as p:
-            browsers = p.chromium
-            browser_executable = browsers.executable_path
-            
+        # Check the shared browser started at startup is still connected
+        if not app.state.browser.is_connected():
+            raise RuntimeError("Shared browser is disconnected")
+        
         return {
             "status": "healthy", 
             "timestamp": datetime.now().isoformat(),
             "environment": "Google Cloud Run",
             "engine": "Playwright",
-            "browser_path": str(browser_executable),
+            "browser_path": app.state.browser_path,
+            "pdf_concurrency": PDF_CONCURRENCY,
+            "pdf_queue_depth": pdf_queue_depth,
             "python_version": f"{os.sys.version_info.major}.{os.sys.version_info.minor}.{os.sys.version_info.micro}"
         }
     except Exception as e:
@@ -91,39 +478,167 @@ async def health_check():
             "timestamp": datetime.now().isoformat()
         }
 
+async def render_pdf(params: PdfParams) -> bytes:
+    """Render a page to PDF on the shared browser in its own isolated context"""
+    # Create an isolated context on the shared browser for this request
+    context = await app.state.browser.new_context(
+        viewport={
+            'width': params.viewportWidth,
+            'height': params.viewportHeight
+        },
+        device_scale_factor=params.deviceScaleFactor,
+        user_agent=USER_AGENT_TEMPLATE.format(params.viewportWidth, params.viewportHeight),
+        java_script_enabled=params.enableJavaScript,
+        bypass_csp=True
+    )
+    
+    try:
+        # Skip resources that never show up in a printed page
+        blocked_types = frozenset(split_csv(params.blockResources))
+        await context.route('**/*', resource_blocker(blocked_types))
+        
+        page = await context.new_page()
+        
+        # Set longer timeout for slow-loading pages
+        page.set_default_timeout(params.timeout)
+        
+        # Navigate to URL with timeout and wait for content to load
+        await page.goto(params.url, timeout=params.timeout, wait_until=params.waitUntil)
+        
+        # Build CSS rules off the event loop
+        css_content, rule_count = await asyncio.to_thread(build_css, params)
+        await page.add_style_tag(content=css_content)
+        logger.info(f'Applied {rule_count} CSS rules including page break controls')
+        
+        # Additional waiting strategies for dynamic content
+        if params.waitForImages or params.waitForIframes or params.waitTime > 0:
+            try:
+                # Scroll once and wait for images and iframes together
+                media_selector = ', '.join(
+                    selector for selector, wanted in (('img', params.waitForImages), ('iframe', params.waitForIframes)) if wanted
+                )
+                if media_selector:
+                    element_count = await page.evaluate(WAIT_FOR_MEDIA_JS, media_selector)
+                    if element_count:
+                        logger.info(f'Waited for {element_count} images/iframes to load')
+                
+                # Additional wait time for other dynamic content
+                if params.waitTime > 0:
+                    logger.info(f'Waiting additional {params.waitTime}ms for dynamic content...')
+                    await page.wait_for_timeout(params.waitTime)
+                
+            except Exception as wait_error:
+                logger.warning(f'Some dynamic content may not have loaded completely: {wait_error}')
+        
+        elif params.waitUntil != 'networkidle':
+            # Nothing else waited for the page to settle, so give pending requests a chance to finish
+            try:
+                await page.wait_for_load_state('networkidle', timeout=5000)
+            except Exception as wait_error:
+                logger.warning(f'Some dynamic content may not have loaded completely: {wait_error}')
+        
+        # Generate PDF with proper options
+        pdf_options = {
+            'landscape': params.landscape,
+            'print_background': params.printBackground,
+            'scale': params.scale,
+            'display_header_footer': params.displayHeaderFooter,
+            'prefer_css_page_size': params.preferCSSPageSize,
+            'margin': {
+                'top': params.marginTop,
+                'bottom': params.marginBottom,
+                'left': params.marginLeft,
+                'right': params.marginRight,
+            }
+        }
+        
+        # Set page size - either format or custom width/height
+        if params.width and params.height:
+            pdf_options['width'] = params.width
+            pdf_options['height'] = params.height
+            logger.info(f'Using custom page size: {params.width} x {params.height}')
+        else:
+            pdf_options['format'] = params.format
+            logger.info(f'Using standard format: {params.format}')
+        
+        if params.pageRanges:
+            pdf_options['page_ranges'] = params.pageRanges
+        
+        if params.displayHeaderFooter:
+            pdf_options['header_template'] = '<span class="title"></span>'
+            pdf_options['footer_template'] = '<span class="pageNumber"></span> of <span class="totalPages"></span>'
+        
+        logger.info(f'Generating PDF with viewport {params.viewportWidth}x{params.viewportHeight}, scale {params.scale}')
+        pdf_content = await page.pdf(**pdf_options)
+    
+    finally:
+        await context.close()
+    
+    return pdf_content
+
+def pdf_filename(parsed_url: ParseResult) -> str:
+    """Derive the download filename from the last URL path segment"""
+    path_segments = [seg for seg in parsed_url.path.split('/') if seg]
+    return f"{path_segments[-1]}.pdf" if path_segments else "document.pdf"
+
+def pdf_error(url: str, e: Exception) -> HTTPException:
+    """Map a PDF generation failure to the HTTP error returned to the client"""
+    if isinstance(e, HTTPException):
+        return e
+    
+    error_msg = str(e)
+    logger.error(f'PDF conversion failed for URL {url}: {error_msg}')
+    
+    if "TimeoutError" in str(type(e)) or "timeout" in error_msg.lower():
+        return HTTPException(status_code=408, detail="PDF generation timed out")
+    elif "net::" in error_msg or "ERR_" in error_msg:
+        return HTTPException(status_code=502, detail="Unable to access the provided URL")
+    else:
+        return HTTPException(status_code=500, detail=f"PDF generation failed: {error_msg}")
+
+async def generate_pdf(params: PdfParams) -> tuple[bytes, str]:
+    """Return the PDF and its ETag, from the cache or by rendering it in a free slot"""
+    # Serve identical requests from the cache
+    cache_key = pdf_cache_key(params)
+    cached = get_cached_pdf(cache_key)
+    if cached is not None:
+        logger.info(f'Serving cached PDF for URL: {params.url} ({len(cached[0])} bytes)')
+        return cached
+    
+    # Limit how many pages render at once on the shared browser, shedding load when the queue is full
+    if pdf_semaphore.locked():
+        if pdf_queue_depth >= PDF_MAX_QUEUE:
+            logger.warning(f'PDF queue full ({pdf_queue_depth} waiting), rejecting request for URL: {params.url}')
+            raise HTTPException(status_code=503, detail="Server busy, try again later", headers={"Retry-After": PDF_RETRY_AFTER})
+        logger.info(f'PDF concurrency limit ({PDF_CONCURRENCY}) reached, queueing request for URL: {params.url}')
+    
+    try:
+        async with pdf_slot():
+            pdf_content = await render_pdf(params)
+    except Exception as e:
+        raise pdf_error(params.url, e)
+    
+    # Check if PDF has content
+    if len(pdf_content) == 0:
+        logger.error('Generated PDF file is empty')
+        raise HTTPException(status_code=500, detail="Generated PDF is empty")
+    
+    logger.info(f'PDF generated successfully: {len(pdf_content)} bytes')
+    
+    etag = pdf_etag(pdf_content)
+    cache_pdf(cache_key, pdf_content, etag)
+    return pdf_content, etag
+
+def build_zip(files: list[tuple[str, bytes]]) -> bytes:
+    """Bundle PDFs into an uncompressed zip archive (PDF streams are already compressed)"""
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_STORED) as archive:
+        for name, content in files:
+            archive.writestr(name, content)
+    return buffer.getvalue()
+
 @app.get("/pdf")
-async def pdf(
-    request: Request,
-    url: str,
-    displayHeaderFooter: Optional[bool] = True,
-    landscape: Optional[bool] = False,
-    marginBottom: Optional[str] = "0.5in",
-    marginLeft: Optional[str] = "0.2in", 
-    marginRight: Optional[str] = "0.2in",
-    marginTop: Optional[str] = "0.75in",
-    pageRanges: Optional[str] = '',
-    format: Optional[str] = "Letter",  # A4, Letter, Legal, etc.
-    width: Optional[str] = None,  # PDF page width (e.g., "8.5in", "210mm")
-    height: Optional[str] = None,  # PDF page height (e.g., "11in", "297mm")
-    printBackground: Optional[bool] = True,
-    scale: Optional[float] = 0.9,
-    timeout: Optional[int] = 180000,  # Playwright uses milliseconds
-    waitForImages: Optional[bool] = True,  # Wait for images to load
-    waitForIframes: Optional[bool] = True,  # Wait for iframes to load
-    waitTime: Optional[int] = 2000,  # Additional wait time in milliseconds
-    enableJavaScript: Optional[bool] = True,  # Enable/disable JavaScript
-    viewportWidth: Optional[int] = 1280,  # Page width for rendering
-    viewportHeight: Optional[int] = 720,  # Page height for rendering
-    deviceScaleFactor: Optional[float] = 1.0,  # Device pixel ratio
-    preferCSSPageSize: Optional[bool] = False,  # Use CSS @page size
-    hideElements: Optional[str] = None,  # CSS selectors to hide (comma-separated)
-    hideClasses: Optional[str] = None,  # Class names to hide (comma-separated)
-    hideIds: Optional[str] = None,  # IDs to hide (comma-separated)
-    hideTags: Optional[str] = None,  # HTML tags to hide (comma-separated)
-    pageBreakBefore: Optional[str] = None,  # CSS selectors to force page break before
-    pageBreakAfter: Optional[str] = None,  # CSS selectors to force page break after
-    keepTogether: Optional[str] = None,  # CSS selectors to avoid breaking inside
-    customCSS: Optional[str] = None):  # Custom CSS to inject
+async def pdf(request: Request, params: Annotated[PdfParams, Query()]):
     
     # Get client IP for rate limiting
     client_ip = request.client.host if request.client else "unknown"
@@ -134,381 +649,59 @@ async def pdf(
         raise HTTPException(status_code=429, detail="Rate limit exceeded")
     
     # Validate URL
-    if not is_valid_url(url):
-        logger.warning(f'Invalid URL provided: {url}')
+    parsed_url = parse_url(params.url)
+    if parsed_url is None:
+        logger.warning(f'Invalid URL provided: {params.url}')
         raise HTTPException(status_code=400, detail="Invalid URL format")
     
-    # Validate parameters
-    if timeout < 5000 or timeout > 180000:
-        raise HTTPException(status_code=400, detail="Timeout must be between 5000 and 180000 milliseconds")
+    filename = pdf_filename(parsed_url)
     
-    if waitTime < 0 or waitTime > 30000:
-        raise HTTPException(status_code=400, detail="Wait time must be between 0 and 30000 milliseconds")
+    logger.info(f'PDF conversion requested for URL: {params.url} from IP: {client_ip}')
     
-    if scale < 0.1 or scale > 2.0:
-        raise HTTPException(status_code=400, detail="Scale must be between 0.1 and 2.0")
+    pdf_content, etag = await generate_pdf(params)
+    return pdf_response(request, pdf_content, etag, filename)
+
+@app.post("/pdf/batch")
+async def pdf_batch(request: Request, batch: PdfBatchRequest):
+    """Convert several web pages to PDF and return them as a zip archive"""
     
-    if viewportWidth < 320 or viewportWidth > 4000:
-        raise HTTPException(status_code=400, detail="Viewport width must be between 320 and 4000 pixels")
+    # Get client IP for rate limiting; each URL counts as one request
+    client_ip = request.client.host if request.client else "unknown"
     
-    if viewportHeight < 240 or viewportHeight > 4000:
-        raise HTTPException(status_code=400, detail="Viewport height must be between 240 and 4000 pixels")
+    if is_rate_limited(client_ip, cost=len(batch.urls)):
+        logger.warning(f'Rate limit exceeded for IP: {client_ip}')
+        raise HTTPException(status_code=429, detail="Rate limit exceeded")
     
-    logger.info(f'PDF conversion requested for URL: {url} from IP: {client_ip}')
+    # Validate URLs and number the files so repeated names stay distinct
+    filenames = []
+    for index, params in enumerate(batch.urls, start=1):
+        parsed_url = parse_url(params.url)
+        if parsed_url is None:
+            logger.warning(f'Invalid URL provided: {params.url}')
+            raise HTTPException(status_code=400, detail=f"Invalid URL format: {params.url}")
+        filenames.append(f'{index:02d}-{pdf_filename(parsed_url)}')
     
-    # Generate unique filename
-    url_hash = sha256(url.encode('utf-8')).hexdigest()
-    pdf_path = os.path.join(tempfile.gettempdir(), f'pdf_{url_hash}_{int(time.time())}.pdf')
-
+    logger.info(f'Batch PDF conversion requested for {len(batch.urls)} URLs from IP: {client_ip}')
+    
+    batch_semaphore = asyncio.Semaphore(batch.concurrency)
+    
+    async def generate_one(params: PdfParams) -> bytes:
+        async with batch_semaphore:
+            pdf_content, _ = await generate_pdf(params)
+            return pdf_content
+    
+    # Render in parallel, abandoning the rest of the batch on the first failure
+    tasks = [asyncio.create_task(generate_one(params)) for params in batch.urls]
     try:
-        async with async_playwright() as p:
-            # Launch browser with specific args for PDF generation
-            browser = await p.chromium.launch(
-                headless=True,
-                args=[
-                    '--no-sandbox', 
-                    '--disable-dev-shm-usage',
-                    '--disable-web-security',
-                    '--disable-features=VizDisplayCompositor',
-                    f'--window-size={viewportWidth},{viewportHeight}'
-                ]
-            )
-            
-            try:
-                # Create page with specific viewport
-                page = await browser.new_page(viewport={
-                    'width': viewportWidth,
-                    'height': viewportHeight,
-                    'device_scale_factor': deviceScaleFactor
-                })
-                
-                # Emulate print media and set extra HTTP headers
-                await page.emulate_media(media='print')
-                await page.set_extra_http_headers({
-                    'User-Agent': f'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36 PDF-Generator Viewport-{viewportWidth}x{viewportHeight}'
-                })
-                
-                # Configure JavaScript if needed
-                if not enableJavaScript:
-                    await page.set_javascript_enabled(False)
-                
-                # Set longer timeout for slow-loading pages
-                page.set_default_timeout(timeout)
-                
-                # Navigate to URL with timeout and wait for content to load
-                await page.goto(url, timeout=timeout, wait_until='networkidle')
-                
-                # Build CSS rules
-                css_rules = []
-                
-                # Width control
-                css_rules.extend([
-                    f'''body {{
-                        width: {viewportWidth}px !important;
-                        max-width: {viewportWidth}px !important;
-                        min-width: {viewportWidth}px !important;
-                    }}''',
-                    f'''.container, .main, #main, #content, .content {{
-                        width: {viewportWidth}px !important;
-                        max-width: {viewportWidth}px !important;
-                    }}'''
-                ])
-                
-                # Hide elements
-                if hideElements:
-                    selectors = [s.strip() for s in hideElements.split(',') if s.strip()]
-                    for selector in selectors:
-                        css_rules.append(f'{selector} {{ display: none !important; }}')
-                
-                if hideClasses:
-                    classes = [c.strip().lstrip('.') for c in hideClasses.split(',') if c.strip()]
-                    for class_name in classes:
-                        css_rules.append(f'.{class_name} {{ display: none !important; }}')
-                
-                if hideIds:
-                    ids = [i.strip().lstrip('#') for i in hideIds.split(',') if i.strip()]
-                    for id_name in ids:
-                        css_rules.append(f'#{id_name} {{ display: none !important; }}')
-                
-                if hideTags:
-                    tags = [t.strip() for t in hideTags.split(',') if t.strip()]
-                    for tag in tags:
-                        css_rules.append(f'{tag} {{ display: none !important; }}')
-                
-                # Page break controls
-                if pageBreakBefore:
-                    selectors = [s.strip() for s in pageBreakBefore.split(',') if s.strip()]
-                    for selector in selectors:
-                        css_rules.append(f'{selector} {{ break-before: page !important; page-break-before: always !important; }}')
-                
-                if pageBreakAfter:
-                    selectors = [s.strip() for s in pageBreakAfter.split(',') if s.strip()]
-                    for selector in selectors:
-                        css_rules.append(f'{selector} {{ break-after: page !important; page-break-after: always !important; }}')
-                
-                if keepTogether:
-                    selectors = [s.strip() for s in keepTogether.split(',') if s.strip()]
-                    for selector in selectors:
-                        css_rules.append(f'{selector} {{ break-inside: avoid !important; page-break-inside: avoid !important; }}')
-                
-                # Custom CSS
-                if customCSS:
-                    css_rules.append(customCSS)
-                
-                # Build complete CSS with print media queries
-                css_content = f'''
-                    @media print {{
-                        {chr(10).join(css_rules)}
-                        
-                        /* Good defaults for print */
-                        * {{
-                            -webkit-print-color-adjust: exact !important;
-                            color-adjust: exact !important;
-                        }}
-                        
-                        /* Better typography for print */
-                        body {{
-                            font-size: 12pt;
-                            line-height: 1.4;
-                        }}
-                        
-                        h1, h2, h3, h4, h5, h6 {{
-                            break-after: avoid !important;
-                            page-break-after: avoid !important;
-                        }}
-                        
-                        p, li {{
-                            orphans: 3;
-                            widows: 3;
-                        }}
-                        
-                        img {{
-                            max-width: 100% !important;
-                            break-inside: avoid !important;
-                            page-break-inside: avoid !important;
-                        }}
-                        
-                        table {{
-                            break-inside: avoid !important;
-                            page-break-inside: avoid !important;
-                        }}
-                        
-                        pre, blockquote {{
-                            break-inside: avoid !important;
-                            page-break-inside: avoid !important;
-                        }}
-                    }}
-                    
-                    /* Apply rules to screen view too */
-                    {chr(10).join(css_rules)}
-                '''
-                
-                if css_rules:
-                    await page.add_style_tag(content=css_content)
-                    logger.info(f'Applied {len(css_rules)} CSS rules including page break controls')
-                
-                # Additional waiting strategies for dynamic content
-                if waitForImages or waitForIframes or waitTime > 0:
-                    try:
-                        # Wait for the page to be fully loaded
-                        await page.wait_for_load_state('networkidle', timeout=5000)
-                        
-                        if waitForImages:
-                            # Wait for images to load
-                            images = await page.query_selector_all('img')
-                            if images:
-                                logger.info(f'Found {len(images)} images, waiting for them to load...')
-                                
-                                # Scroll through the page to trigger lazy loading
-                                await page.evaluate('''
-                                    () => {
-                                        return new Promise(resolve => {
-                                            let totalHeight = 0;
-                                            const distance = 100;
-                                            const timer = setInterval(() => {
-                                                const scrollHeight = document.body.scrollHeight;
-                                                window.scrollBy(0, distance);
-                                                totalHeight += distance;
-                                                
-                                                if(totalHeight >= scrollHeight){
-                                                    clearInterval(timer);
-                                                    resolve();
-                                                }
-                                            }, 100);
-                                        });
-                                    }
-                                ''')
-                                
-                                # Wait for images to load
-                                await page.evaluate('''
-                                    async () => {
-                                        const images = Array.from(document.querySelectorAll('img'));
-                                        const imagePromises = images.map(img => {
-                                            if (img.complete && img.naturalHeight !== 0) {
-                                                return Promise.resolve();
-                                            }
-                                            return new Promise(resolve => {
-                                                img.onload = () => resolve();
-                                                img.onerror = () => resolve(); // Resolve even on error to not block
-                                                // Set a timeout to avoid hanging
-                                                setTimeout(() => resolve(), 5000);
-                                            });
-                                        });
-                                        await Promise.all(imagePromises);
-                                    }
-                                ''')
-                                
-                                # Scroll back to top
-                                await page.evaluate('window.scrollTo(0, 0)')
-                                await page.wait_for_timeout(500)
-                        
-                        if waitForIframes:
-                            # Wait for images to load
-                            iframes = await page.query_selector_all('iframe')
-                            if iframes:
-                                logger.info(f'Found {len(iframes)} iframes, waiting for them to load...')
-                                
-                                # Scroll through the page to trigger lazy loading
-                                await page.evaluate('''
-                                    () => {
-                                        return new Promise(resolve => {
-                                            let totalHeight = 0;
-                                            const distance = 100;
-                                            const timer = setInterval(() => {
-                                                const scrollHeight = document.body.scrollHeight;
-                                                window.scrollBy(0, distance);
-                                                totalHeight += distance;
-                                                
-                                                if(totalHeight >= scrollHeight){
-                                                    clearInterval(timer);
-                                                    resolve();
-                                                }
-                                            }, 100);
-                                        });
-                                    }
-                                ''')
-                                
-                                # Wait for iframes to load
-                                await page.evaluate('''
-                                    async () => {
-                                        const iframes = Array.from(document.querySelectorAll('iframe'));
-                                        const iframePromises = iframes.map(iframe => {
-                                            if (iframe.complete && iframe.naturalHeight !== 0) {
-                                                return Promise.resolve();
-                                            }
-                                            return new Promise(resolve => {
-                                                iframe.onload = () => resolve();
-                                                iframe.onerror = () => resolve(); // Resolve even on error to not block
-                                                // Set a timeout to avoid hanging
-                                                setTimeout(() => resolve(), 5000);
-                                            });
-                                        });
-                                        await Promise.all(iframePromises);
-                                    }
-                                ''')
-                                
-                                # Scroll back to top
-                                await page.evaluate('window.scrollTo(0, 0)')
-                                await page.wait_for_timeout(500)
-                                
-                        # Additional wait time for other dynamic content
-                        if waitTime > 0:
-                            logger.info(f'Waiting additional {waitTime}ms for dynamic content...')
-                            await page.wait_for_timeout(waitTime)
-                        
-                        # Wait for any ongoing network requests to complete
-                        await page.wait_for_load_state('networkidle', timeout=5000)
-                        
-                    except Exception as wait_error:
-                        logger.warning(f'Some dynamic content may not have loaded completely: {wait_error}')
-                
-                # Generate PDF with proper options
-                pdf_options = {
-                    'path': pdf_path,
-                    'landscape': landscape,
-                    'print_background': printBackground,
-                    'scale': scale,
-                    'display_header_footer': displayHeaderFooter,
-                    'prefer_css_page_size': preferCSSPageSize,
-                    'margin': {
-                        'top': marginTop,
-                        'bottom': marginBottom,
-                        'left': marginLeft,
-                        'right': marginRight,
-                    }
-                }
-                
-                # Set page size - either format or custom width/height
-                if width and height:
-                    pdf_options['width'] = width
-                    pdf_options['height'] = height
-                    logger.info(f'Using custom page size: {width} x {height}')
-                else:
-                    pdf_options['format'] = format
-                    logger.info(f'Using standard format: {format}')
-                
-                if pageRanges:
-                    pdf_options['page_ranges'] = pageRanges
-                
-                if displayHeaderFooter:
-                    pdf_options['header_template'] = '<span class="title"></span>'
-                    pdf_options['footer_template'] = '<span class="pageNumber"></span> of <span class="totalPages"></span>'
-                
-                logger.info(f'Generating PDF with viewport {viewportWidth}x{viewportHeight}, scale {scale}')
-                await page.pdf(**pdf_options)
-                
-            finally:
-                await browser.close()
-        
-        # Check if file was created successfully
-        if not os.path.exists(pdf_path):
-            logger.error(f'PDF file was not created: {pdf_path}')
-            raise HTTPException(status_code=500, detail="PDF generation failed")
-        
-        # Read PDF file safely
-        try:
-            with open(pdf_path, 'rb') as pdf_file:
-                pdf_content = pdf_file.read()
-        except IOError as e:
-            logger.error(f'Failed to read PDF file: {e}')
-            raise HTTPException(status_code=500, detail="Failed to read generated PDF")
-        
-        # Check if PDF has content
-        if len(pdf_content) == 0:
-            logger.error('Generated PDF file is empty')
-            raise HTTPException(status_code=500, detail="Generated PDF is empty")
-        
-        logger.info(f'PDF generated successfully: {len(pdf_content)} bytes')
-                
-        parsed_url = urlparse(url)
-        path_segments = [seg for seg in parsed_url.path.split('/') if seg]
-        filename = f"{path_segments[-1]}.pdf" if path_segments else "document.pdf"
-
-        return Response(
-            status_code=200,
-            media_type='application/pdf',
-            content=pdf_content,
-            headers={
-                "Content-Disposition": f"attachment; filename={filename}",
-                "Cache-Control": "no-cache, no-store, must-revalidate",
-            }
-        )
-        
-    except Exception as e:
-        error_msg = str(e)
-        logger.error(f'PDF conversion failed for URL {url}: {error_msg}')
-        
-        if "TimeoutError" in str(type(e)) or "timeout" in error_msg.lower():
-            raise HTTPException(status_code=408, detail="PDF generation timed out")
-        elif "net::" in error_msg or "ERR_" in error_msg:
-            raise HTTPException(status_code=502, detail="Unable to access the provided URL")
-        else:
-            raise HTTPException(status_code=500, detail=f"PDF generation failed: {error_msg}")
+        pdf_contents = await asyncio.gather(*tasks)
+    except Exception:
+        for task in tasks:
+            task.cancel()
+        raise
     
-    finally:
-        # Clean up
-        try:
-            if os.path.exists(pdf_path):
-                os.remove(pdf_path)
-        except OSError as e:
-            logger.warning(f'Failed to clean up temporary file {pdf_path}: {e}')
+    zip_content = await asyncio.to_thread(build_zip, list(zip(filenames, pdf_contents)))
+    logger.info(f'Batch PDF archive generated successfully: {len(zip_content)} bytes')
+    
+    return download_response(zip_content, 'application/zip', {
+        "Content-Disposition": "attachment; filename=documents.zip",
+    })
@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import argparse, uvicorn
+import argparse, os, uvicorn
 
 if __name__ == '__main__':
     
@@ -9,5 +9,15 @@ if __name__ == '__main__':
     parser.add_argument('--reload', type=bool, default=True, help='Reload on change')
     parser.add_argument('--port', type=int, default=8888, help='HTTP port')
     parser.add_argument('--host', type=str, default='127.0.0.1', help='Host to bind to')
+    parser.add_argument('--workers', type=int, default=int(os.getenv('WEB_CONCURRENCY', '1')), help='Worker processes (ignored with --reload)')
     args = parser.parse_args()
-    uvicorn.run('pdf_service:app', host=args.host, port=args.port, reload=args.reload)
\ No newline at end of file
+    uvicorn.run(
+        'pdf_service:app',
+        host=args.host,
+        port=args.port,
+        reload=args.reload,
+        workers=args.workers,
+        loop='uvloop',
+        http='httptools',
+        timeout_keep_alive=5
+    )
\ No newline at end of file